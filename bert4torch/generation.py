@@ -27,6 +27,19 @@ def repetition_penalty_func(input_ids: torch.LongTensor, scores: torch.FloatTens
     return scores
 
 
+def token_ids_to_list(output_ids: Union[torch.Tensor, list, tuple]) -> list:
+    '''把generate输出的token_ids(不等长的list(tensor)或tensor)一次性转到cpu, 并转为list(list)
+    避免每条样本单独.cpu()带来的多次同步
+    '''
+    if isinstance(output_ids, torch.Tensor):
+        return output_ids.cpu().tolist()
+    elif len(output_ids) == 0:
+        return []
+    lengths = [len(ids) for ids in output_ids]
+    flat_ids = torch.cat([ids.reshape(-1) for ids in output_ids]).cpu()
+    return [ids.tolist() for ids in torch.split(flat_ids, lengths)]
+
+
 class EmptyCacheDecorators(object):
     optimize_cuda_cache = False
 
@@ -406,7 +406,8 @@ class DPOLoss:
         # dummy token; we'll ignore the losses on these tokens later
         labels[labels == self.pad_token_id] = 0
 
-        per_token_logps = torch.gather(logits.log_softmax(-1), dim=2, index=labels.unsqueeze(2)).squeeze(2)
+        # 在log_softmax内部转float32, 避免先对[btz, seq_len, vocab_size]的logits整体做一次类型转换
+        per_token_logps = torch.gather(logits.log_softmax(-1, dtype=torch.float32), dim=2, index=labels.unsqueeze(2)).squeeze(2)
 
         if self.average_log_prob:
             all_logps = (per_token_logps * loss_mask).sum(-1) / loss_mask.sum(-1)
@@ -434,11 +435,11 @@ class CausalLMLoss(nn.CrossEntropyLoss):
         labels: 即token_ids, [btz, seq_len]
         """
         raw_dtyps = logits.dtype
-        logits = logits.to(torch.float32)
-
         if self.offset:
-            logits = logits[:, :-1, :].contiguous()  # 预测序列，错开一位
+            # 先切片再转float32, 转换时即生成连续的tensor, 少一次[btz, seq_len, vocab_size]的拷贝
+            logits = logits[:, :-1, :]  # 预测序列，错开一位
             labels = labels[:, 1:].contiguous() # 目标token_ids
+        logits = logits.to(torch.float32)
 
         logits = logits.reshape(-1, logits.shape[-1])
         labels = labels.flatten()
@@ -54,6 +54,7 @@ def build_transformer_model(config_path:Union[str, os.PathLike]=None, checkpoint
     :param keep_hidden_layers: 保留的hidden_layer层的id, 默认为None表示全部使用
     :param hierarchical_position: 是否层次分解位置编码, 默认为None表示不使用
     :param gradient_checkpoint: bool, 是否使用gradient_checkpoint, 默认为False
+    :param checkpoint_every_n_layers: int, 每n层中仅第1层做gradient_checkpoint, 默认为1表示每层都做, n越大显存越高但重计算越少
     :param add_trainer: bool, 指定从BaseModel继承, 若build_transformer_model后需直接compile()、fit()需设置为True, 默认为None
     :param verbose: int, 是否显示加载权重的[WARNING]信息, 默认为1表示显示未加载的, 2表示显示所有不匹配的, 0表示不显示
 
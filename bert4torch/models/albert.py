@@ -18,7 +18,7 @@ class ALBERT(BERT):
         for l_i in range(self.num_hidden_layers):
             model_kwargs = self.apply_on_layer_begin(l_i, **model_kwargs)
             layer_module = self.encoderLayer[0]
-            outputs = self.layer_forward(layer_module, model_kwargs)
+            outputs = self.layer_forward(layer_module, model_kwargs, l_i=l_i)
             model_kwargs.update(outputs)
             hidden_states = model_kwargs['hidden_states']
             model_kwargs = self.apply_on_layer_end(l_i, **model_kwargs)
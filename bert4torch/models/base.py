@@ -4,6 +4,7 @@
 '''
 import torch
 from torch import nn
+from packaging import version
 from bert4torch.layers import LayerNorm
 from bert4torch.snippets import log_warn, load_state_dict_into_meta_model, find_tied_parameters, JsonConfig
 from bert4torch.snippets import get_parameter_device, load_checkpoint, save_checkpoint, copytree
@@ -40,6 +41,7 @@ class BERT_BASE(nn.Module):
             keep_hidden_layers:List[int]=None, # 保留的hidden_layer层的id
             hierarchical_position:Union[bool, float]=None,  # 是否层次分解位置编码
             gradient_checkpoint:bool=False, # 是否使用gradient_checkpoint
+            checkpoint_every_n_layers:int=1, # 每n层中仅第1层做gradient_checkpoint
             output_all_encoded_layers:bool=False, # 是否返回所有layer的hidden_states
             tie_emb_prj_weight:bool=False,  # 是否绑定embedding和lm_head的权重
             return_dict:bool=False,  # 是否返回的格式是dict
@@ -72,6 +74,7 @@ class BERT_BASE(nn.Module):
         self.keep_hidden_layers = set(range(num_hidden_layers)) if keep_hidden_layers is None else set(keep_hidden_layers)
         self.hierarchical_position = hierarchical_position
         self.gradient_checkpoint = gradient_checkpoint
+        self.checkpoint_every_n_layers = self._check_every_n_layers(checkpoint_every_n_layers)
         self.quantized = False
         self.output_all_encoded_layers = output_all_encoded_layers
         self.add_trainer = kwargs['add_trainer']
@@ -81,14 +84,32 @@ class BERT_BASE(nn.Module):
     def tie_weights(self):
         pass
     
-    def gradient_checkpointing_enable(self):
+    def gradient_checkpointing_enable(self, checkpoint_every_n_layers:int=None):
+        '''开启gradient_checkpoint
+
+        :param checkpoint_every_n_layers: int, 每n层中仅第1层做重计算, 其余层正常保存激活值; 
+            默认为1表示每层都做, n越大显存占用越高(约为不开启时的1-1/n), 但重计算耗时越少
+        '''
         self.gradient_checkpoint=True
+        if checkpoint_every_n_layers is not None:
+            self.checkpoint_every_n_layers = self._check_every_n_layers(checkpoint_every_n_layers)
+
+    @staticmethod
+    def _check_every_n_layers(checkpoint_every_n_layers):
+        if (not isinstance(checkpoint_every_n_layers, int)) or (checkpoint_every_n_layers < 1):
+            raise ValueError(f'Args `checkpoint_every_n_layers` should be int >= 1, but got {checkpoint_every_n_layers}')
+        return checkpoint_every_n_layers
 
     def enable_input_require_grads(self):
         """transformer移植来
         Enables the gradients for the input embeddings. This is useful for fine-tuning adapter weights while keeping
         the model weights fixed.
+        1) 仅reentrant方式的checkpoint(torch<1.11.0)要求输入requires_grad, use_reentrant=False时无需每步forward都调用hook
+        2) embedding权重本身可训练时, 输出天然requires_grad, 也无需hook
         """
+        self._require_grads_hook = None
+        if version.parse(torch.__version__) >= version.parse("1.11.0") or self.get_input_embeddings().weight.requires_grad:
+            return
 
         def make_inputs_require_grads(module, input, output):
             output.requires_grad_(True)
@@ -99,7 +120,9 @@ class BERT_BASE(nn.Module):
         """transformer移植来
         Removes the `_require_grads_hook`.
         """
-        self._require_grads_hook.remove()
+        if getattr(self, '_require_grads_hook', None) is not None:
+            self._require_grads_hook.remove()
+            self._require_grads_hook = None
 
     def get_kw(self, *args, **kwargs):
         '''把self.属性设置到kwargs中, 方便传参'''
@@ -83,9 +83,12 @@ class BERT(BERT_BASE):
         """获取word_embeddings"""
         return self.embeddings.word_embeddings
     
-    def layer_forward(self, layer, model_kwargs, use_reentrant=False):
-        """transformer block的forward"""
-        if self.gradient_checkpoint and self.training:
+    def layer_forward(self, layer, model_kwargs, use_reentrant=False, l_i=None):
+        """transformer block的forward
+
+        :param l_i: int, 当前层的序号, 配合checkpoint_every_n_layers仅对部分层做gradient_checkpoint
+        """
+        if self.gradient_checkpoint and self.training and (l_i is None or l_i % self.checkpoint_every_n_layers == 0):
             if (use_reentrant is True) or version.parse(torch.__version__) < version.parse("1.11.0"):
                 # 此种方式要求输入输出是位置参数
                 return old_checkpoint(layer, model_kwargs)
@@ -225,7 +228,7 @@ class BERT(BERT_BASE):
         encoded_layers = [model_kwargs['hidden_states']] # 添加embedding的输出
         for l_i, layer_module in enumerate(self.encoderLayer):
             model_kwargs = self.apply_on_layer_begin(l_i, **model_kwargs)
-            outputs = self.layer_forward(layer_module, model_kwargs)
+            outputs = self.layer_forward(layer_module, model_kwargs, l_i=l_i)
             model_kwargs.update(outputs)
             hidden_states = model_kwargs['hidden_states']
             model_kwargs = self.apply_on_layer_end(l_i, **model_kwargs)
@@ -44,7 +44,7 @@ class DebertaV2(BERT):
         encoded_layers = [model_kwargs['hidden_states']] # 添加embedding的输出
         for l_i, layer_module in enumerate(self.encoderLayer):
             model_kwargs = self.apply_on_layer_begin(l_i, **model_kwargs)
-            outputs = self.layer_forward(layer_module, model_kwargs)
+            outputs = self.layer_forward(layer_module, model_kwargs, l_i=l_i)
             model_kwargs.update(outputs)
             # 第0层要经过卷积
             if l_i == 0 and self.conv is not None:
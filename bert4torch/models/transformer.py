@@ -66,7 +66,7 @@ class Decoder(LM_Mask, BERT):
         decoded_layers = [model_kwargs['hidden_states']] # 添加embedding的输出
         for l_i, layer_module in enumerate(self.decoderLayer):
             model_kwargs = self.apply_on_layer_begin(l_i, **model_kwargs)
-            outputs = self.layer_forward(layer_module, model_kwargs)
+            outputs = self.layer_forward(layer_module, model_kwargs, l_i=l_i)
             model_kwargs.update(outputs)
             hidden_states = model_kwargs['hidden_states']
             model_kwargs = self.apply_on_layer_end(l_i, **model_kwargs)
@@ -84,7 +84,8 @@ class Decoder(LM_Mask, BERT):
         if self.final_layernorm:
             last_hidden_state = self.LayerNormFinal(last_hidden_state)
         
-        if self.with_lm:
+        # 允许调用时通过with_lm=False仅返回hidden_states, 而不修改self.with_lm属性
+        if model_kwargs.get('with_lm', self.with_lm):
             lm_logits = self.lm_head(last_hidden_state)  # [btz, seq_len, vocab_size]
             lm_logits = lm_logits * self.logit_scale if hasattr(self, 'logit_scale') else lm_logits
             lm_logits = self.final_activation(lm_logits)
@@ -164,7 +164,7 @@ class Transformer_XL(BERT):
             mems_i = None if self.mems is None else self.mems[l_i]
             model_kwargs['mems_i'] = mems_i
             model_kwargs = self.apply_on_layer_begin(l_i, **model_kwargs)
-            outputs = self.layer_forward(layer_module, model_kwargs)
+            outputs = self.layer_forward(layer_module, model_kwargs, l_i=l_i)
             model_kwargs.update(outputs)
             hidden_states = model_kwargs['hidden_states']
             model_kwargs = self.apply_on_layer_end(l_i, **model_kwargs)
@@ -11,6 +11,7 @@ import os
 from torch.utils.checkpoint import CheckpointFunction
 import shutil
 import re
+from contextlib import nullcontext
 from torch4keras.snippets import log_info, log_warn, Timeit
 
 
@@ -166,6 +167,18 @@ def cuda_empty_cache(device=None):
             torch.cuda.ipc_collect()
 
 
+def inference_autocast(device=None, enabled=True):
+    '''纯推理(如ref_model, reward_model)使用的autocast上下文
+    1) cuda设备支持bf16时使用bf16, 否则使用fp16
+    2) 非cuda设备或者enabled=False时不做任何转换
+    '''
+    device_type = torch.device(device).type if device is not None else 'cuda'
+    if (not enabled) or (device_type != 'cuda') or (not torch.cuda.is_available()):
+        return nullcontext()
+    dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    return torch.autocast(device_type='cuda', dtype=dtype)
+
+
 class GenerateSpeed(Timeit):
     '''上下文管理器，计算token生成的速度
 
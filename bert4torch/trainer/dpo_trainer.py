@@ -1,6 +1,10 @@
 import torch
 from torch4keras.trainer import Trainer
 from bert4torch.models import BaseModel
+from bert4torch.generation import model_inference_mode
+from bert4torch.snippets import log_warn, inference_autocast, get_parameter_device
+from contextlib import contextmanager
+from packaging import version
 import copy
 
 
@@ -8,27 +12,108 @@ class DPOTrainer(Trainer):
     '''使用dpo算法进行人类偏好对齐
 
     :param model: 待训练模型
-    :param ref_model: 参考模型
+    :param ref_model: 参考模型, 为None时peft模型直接关闭adapter作为参考模型, 否则deepcopy一份model
+    :param torch_compile: bool, 是否使用torch.compile加速policy和ref的forward, 需torch>=2.0, 默认为False
+    :param ref_autocast: bool, 参考模型是否在bf16(不支持时为fp16)的autocast下推理, 默认为False; 
+        若同时支持bf16, 则参考模型的权重也转为bf16, 显存减半且推理更快; 但参考模型和fp32的policy数值不再一致, 
+        第0步时policy和ref的logps也不相等, rewards/margins/accuracies从一开始就带有噪声, 开启前需自行评估
+    :param quantize_ref: bool, 是否对参考模型做4bit(nf4)量化, 需安装bitsandbytes且参考模型在cuda上, 默认为False; 
+        参考模型仅推理, 量化后显存约为1/4, 但会有少量精度损失, 建议先对比量化前后参考模型在验证集上的ppl; 
+        量化后参考模型总是在和4bit计算精度一致的bf16(不支持时为fp16)的autocast下推理, 不受ref_autocast影响
     '''
-    def __init__(self, model:BaseModel, ref_model:BaseModel=None):
+    def __init__(self, model:BaseModel, ref_model:BaseModel=None, torch_compile:bool=False, ref_autocast:bool=False, 
+                 quantize_ref:bool=False):
         super().__init__()
         self.model = model
         self.model.print_trainable_parameters()
-        self.ref_model = ref_model or copy.deepcopy(self.model)
-        for p in self.ref_model.parameters():
-            p.requires_grad = False
-        self.ref_model.print_trainable_parameters()
+        self.ref_autocast = ref_autocast
+        # peft模型关闭adapter后即为原始模型，无需再复制一份权重
+        self.is_peft_model = hasattr(self.model, 'disable_adapter_layers')
+        if (ref_model is None) and self.is_peft_model:
+            self.ref_model = None
+            if quantize_ref:
+                log_warn('Args `quantize_ref` is ignored because peft model uses disabled adapters as ref_model, no separate ref_model to quantize')
+        else:
+            self.ref_model = ref_model or copy.deepcopy(self.model)
+            self.ref_model.requires_grad_(False)
+            self.ref_model.eval()
+            if quantize_ref:
+                self.quantize_ref_model()
+            elif self.ref_autocast and self._ref_bf16_available():
+                self.ref_model.to(dtype=torch.bfloat16)
+            self.ref_model.print_trainable_parameters()
 
-    def _forward(self, *inputs, **input_kwargs):
-        '''修改父类的_forward来获取输出'''
-        policy_logits = self._argparse_forward(self.model, *inputs, **input_kwargs).to(torch.float32)
+        # forward时实际调用的模块, self.model/self.ref_model保持不变, 以免影响权重保存和加载
+        self.policy_forward, self.ref_forward = self.model, self.ref_model
+        if torch_compile:
+            self.compile_forward()
+
+    def _ref_bf16_available(self):
+        '''参考模型在cuda上, 支持bf16, 且未量化时, 权重可以直接转为bf16'''
+        if getattr(self.ref_model, 'quantized', False):
+            return False
+        return (get_parameter_device(self.ref_model).type == 'cuda') and torch.cuda.is_bf16_supported()
+
+    def quantize_ref_model(self):
+        '''参考模型量化为4bit(nf4), 计算使用bf16(不支持时为fp16), forward时自动开启对应的autocast'''
+        from transformers import BitsAndBytesConfig
+        device = get_parameter_device(self.ref_model)
+        if device.type != 'cuda':
+            # bitsandbytes仅在权重移动到cuda上时才真正量化
+            raise ValueError(f'Args `quantize_ref` requires ref_model on cuda device, but got {device}')
+        compute_dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float16
+        q_config = BitsAndBytesConfig(load_in_4bit=True,
+                                      bnb_4bit_quant_type='nf4',
+                                      bnb_4bit_compute_dtype=compute_dtype,
+                                      llm_int8_skip_modules=['lm_head']
+                                      )
+        self.ref_model = self.ref_model.quantize(quantization_method='load_in_4bit', quantization_config=q_config).to(device)
         self.ref_model.eval()
-        with torch.no_grad():
-            reference_logits = self._argparse_forward(self.ref_model, *inputs, **input_kwargs).to(torch.float32)
-        
+
+    def compile_forward(self):
+        '''使用torch.compile编译policy和ref的forward'''
+        if version.parse(torch.__version__) < version.parse("2.0.0"):
+            log_warn('Args `torch_compile` requires torch>=2.0.0, skip compiling')
+            return
+        torch.set_float32_matmul_precision('high')  # 启用TF32
+        # policy在peft时会在开/关adapter下各调用一次, 因此不使用cudagraph的reduce-overhead模式
+        self.policy_forward = torch.compile(self.model)
+        if self.ref_model is not None:
+            # ref_model不需要反向传播, 可以花更多的编译时间换取推理速度
+            self.ref_forward = torch.compile(self.ref_model, mode='max-autotune')
+
+    @contextmanager
+    def null_ref_context(self):
+        '''ref_model为None时, 关闭policy模型的adapter来作为参考模型'''
+        training = self.model.training
+        self.model.eval()
+        self.model.disable_adapter_layers()
+        try:
+            yield
+        finally:
+            self.model.enable_adapter_layers()
+            self.model.train(training)
+
+    def _forward(self, *inputs, **input_kwargs):
+        '''修改父类的_forward来获取输出
+        1) 不在这里转float32, 而是在loss计算log_softmax时转换, 减少[btz, seq_len, vocab_size]的显存占用
+        2) 参考模型无需梯度, 使用inference_mode, ref_autocast=True或参考模型已量化时在bf16的autocast下推理
+        '''
+        policy_logits = self._argparse_forward(self.policy_forward, *inputs, **input_kwargs)
+        ref_device = get_parameter_device(self.ref_model or self.model)
+        # 4bit量化的参考模型本身就以bf16(不支持时为fp16)计算, 使用相同精度的autocast可避免每个Linear4bit前后fp32和bf16的来回转换
+        ref_autocast = self.ref_autocast or getattr(self.ref_model, 'quantized', False)
+        with model_inference_mode(), inference_autocast(ref_device, enabled=ref_autocast):
+            if self.ref_model is None:
+                with self.null_ref_context():
+                    reference_logits = self._argparse_forward(self.policy_forward, *inputs, **input_kwargs)
+            else:
+                self.ref_model.eval()
+                reference_logits = self._argparse_forward(self.ref_forward, *inputs, **input_kwargs)
+
         return policy_logits, reference_logits
 
     def unwrap_model(self):
         '''返回nn.Module模块
         '''
-        return self.model
\ No newline at end of file
+        return self.model
@@ -4,8 +4,10 @@ import torch
 from torch import nn
 from torch4keras.trainer import Trainer
 from bert4torch.models import BaseModel
-from bert4torch.generation import SeqGeneration, Seq2SeqGeneration
-from bert4torch.snippets import DottableDict, is_trl_available
+from bert4torch.generation import SeqGeneration, Seq2SeqGeneration, model_inference_mode, token_ids_to_list
+from bert4torch.snippets import DottableDict, is_trl_available, inference_autocast
+from collections import OrderedDict
+import inspect
 
 
 try:
@@ -23,14 +25,21 @@ class PPOTrainer(PPOTrainerTrl, Trainer):
     :param generation_kwargs: generation使用的genration_kwargs
     :param reward_model: 奖励模型，可以用bert4torch构建的，也可以用transformers格式的
     :param reward_tokenizer: 奖励模型的tokenizer
+    :param reward_cache_size: int, 缓存的(query, response)奖励分数的个数, 重复出现时不再计算reward_model, 设置为0表示不缓存
+    :param reward_autocast: bool, reward_model是否在bf16(不支持时为fp16)的autocast下推理, 默认为False; 
+        开启后推理更快, 但score和fp32下不完全一致, 会给rewards引入额外噪声, 开启前需自行评估
     '''
-    def __init__(self, *args, generation_kwargs=None, reward_model=None, reward_tokenizer=None, **kwargs):
+    def __init__(self, *args, generation_kwargs=None, reward_model=None, reward_tokenizer=None, reward_cache_size=4096, 
+                 reward_autocast=False, **kwargs):
         if not is_trl_available():
             raise ImportError('Please install trl by running `pip install trl`')
         Trainer.__init__(self)
         PPOTrainerTrl.__init__(self, *args, **kwargs)
         self.reward_model = reward_model
         self.reward_tokenizer = reward_tokenizer
+        self.reward_cache_size = reward_cache_size
+        self.reward_autocast = reward_autocast
+        self.reward_cache = OrderedDict()  # LRU缓存, key为(query, response)
         self.generation_kwargs = generation_kwargs or {}
         self.reward_baseline = kwargs.pop('reward_baseline', 0)
         self.grad_accumulation_steps = self.config.gradient_accumulation_steps
@@ -59,8 +68,7 @@ class PPOTrainer(PPOTrainerTrl, Trainer):
                 self._init_weights(self, **kwargs)
             
             def forward(self, *args, **kwargs):
-                self.module.with_lm = False
-                hidden_states = self.module(kwargs['input_ids'])
+                hidden_states = self.module(kwargs['input_ids'], with_lm=False)  # 仅本次调用不过lm_head
                 lm_logits = self.module.lm_head(hidden_states)
                 value = self.v_head(hidden_states).squeeze(-1)
                 return lm_logits, None, value
@@ -74,21 +82,17 @@ class PPOTrainer(PPOTrainerTrl, Trainer):
         else:
             raise ValueError('Args `train_X` format illegel')
         
-        # actor生成得到推理结果
-        responses = []
-        self.generation.decoder.with_lm = True  # 输出lm_logits
+        # actor生成得到推理结果, 一次性转到cpu后batch_decode
         response_tensors = self.generation.generate(question_tensors, **self.generation_kwargs)
-        self.generation.decoder.with_lm = False
-        for response_tensor in response_tensors:
-            r = self.tokenizer.decode(response_tensor, skip_special_tokens=True)
-            responses.append(r)
+        responses = self.tokenizer.batch_decode(token_ids_to_list(response_tensors), skip_special_tokens=True)
 
         # Compute reward score
-        score_outputs = [self.get_reward_model_output(q, r) for q, r in zip(query, responses)]
+        score_outputs = self.get_reward_model_output(query, responses)
         rewards = self.calculate_rewards(score_outputs, self.reward_baseline)
 
         # Run PPO step
-        self.question_tensors = [i for i in question_tensors]
+        # trl的step要求queries为list(tensor)
+        self.question_tensors = list(question_tensors.unbind(0)) if isinstance(question_tensors, torch.Tensor) else question_tensors
         self.response_tensors = response_tensors
         self.rewards = rewards
         self.ppo_step = True
@@ -96,7 +100,8 @@ class PPOTrainer(PPOTrainerTrl, Trainer):
         
         batch = {'query': query, 'response': responses}
         self.log_stats(stats, batch, rewards)
-        loss = torch.tensor(stats['ppo/loss/total'])
+        loss = stats['ppo/loss/total']
+        loss = loss.detach() if isinstance(loss, torch.Tensor) else torch.as_tensor(loss)
         loss_detail = {k:v for k,v in stats.items() if isinstance(v, (int, float))}  # 更新到logs中
         # 按照output, loss, loss_detail个顺序返回
         return None, loss, loss_detail
@@ -110,40 +115,100 @@ class PPOTrainer(PPOTrainerTrl, Trainer):
     def calculate_rewards(reward_score_outputs, reward_baseline=0):
         """
         Calculate the reward for a given score output.
-        :param reward_score_outputs: 
+        :param reward_score_outputs: tensor, [btz]/[btz, num_labels], 也兼容list(tensor)
         :param reward_baseline: 
-        :return: 
+        :return: list(tensor), 每个元素是0维tensor
         """
-        rewards = []
-        for score in reward_score_outputs:
-            if isinstance(score, torch.Tensor) and score.numel() == 1:
-                reward_value = score.item() - reward_baseline
-                rewards.append(torch.tensor(reward_value))
-            else:
+        # 全部使用tensor计算, 不调用.item(), 避免每个样本一次device到host的同步
+        if isinstance(reward_score_outputs, (tuple, list)):
+            scores = torch.stack([torch.as_tensor(score).float().mean() for score in reward_score_outputs])
+        else:
+            scores = reward_score_outputs.float()
+            if scores.dim() > 1:
                 # Use the average of the tensor elements as `score` is multiple elements
-                reward_value = torch.mean(score).item() - reward_baseline
-                rewards.append(torch.tensor(reward_value))
-        return rewards
+                scores = scores.reshape(scores.shape[0], -1).mean(dim=-1)
+        rewards = scores - reward_baseline
+        return list(rewards.unbind(0))
     
-    def get_reward_model_output(self, question, answer):
+    def get_reward_model_output(self, questions, answers):
         """
-        Get the reward score for a given question and answer pair.
+        Get the reward scores for a batch of question and answer pairs.
+        :param questions: list[str]
+        :param answers: list[str]
+        :return: tensor, [btz, num_labels]
         """
-        # 这里reward_tokenizer是transformer格式的
-        inputs = self.reward_tokenizer(question, answer, return_tensors='pt').to(self.reward_model.device)
+        if not self.reward_cache_size:
+            return self._reward_model_forward(questions, answers)
+
+        # 仅对未命中缓存的(query, response)去重后batch计算
+        keys = list(zip(questions, answers))
+        miss_keys = list(dict.fromkeys(key for key in keys if key not in self.reward_cache))
+        if miss_keys:
+            miss_scores = self._reward_model_forward([key[0] for key in miss_keys], [key[1] for key in miss_keys])
+            self.reward_cache.update(zip(miss_keys, miss_scores.unbind(0)))
+
+        score = torch.stack([self.reward_cache[key] for key in keys])
+        for key in keys:
+            self.reward_cache.move_to_end(key)
+        while len(self.reward_cache) > self.reward_cache_size:
+            self.reward_cache.popitem(last=False)
+        return score
+
+    @model_inference_mode()
+    def _reward_model_forward(self, questions, answers):
+        '''reward_model的batch推理
+        1) bert4torch格式的模型左侧padding, 和step2_reward训练时一致, 以便取最后一个位置的score; 
+           transformer格式的模型保持tokenizer自身的padding_side, 由attention_mask/pad_token_id处理pooling
+        2) tokenizer没有pad_token, 或transformer格式模型未设置config.pad_token_id时无法batch, 退化为逐条推理
+        '''
+        if self.reward_model.training:
+            self.reward_model.eval()
+        if not self._reward_batch_available():
+            return torch.cat([self._reward_model_forward_batch([q], [a]) for q, a in zip(questions, answers)], dim=0)
+        return self._reward_model_forward_batch(questions, answers)
+
+    def _reward_batch_available(self):
+        '''是否可以padding后batch推理reward_model'''
+        if self.reward_tokenizer.pad_token_id is None:
+            return False
         if isinstance(self.reward_model, BaseModel):
-            # bert4torch格式
-            score = self.reward_model(inputs['input_ids'])
-            if isinstance(score, torch.Tensor):
-                score = score.cpu().detach()
-            elif isinstance(score, (list, tuple)):
-                score = score[0].cpu().detach()
+            return True
+        return getattr(getattr(self.reward_model, 'config', None), 'pad_token_id', None) is not None
+
+    def _reward_forward_accept_attention_mask(self):
+        '''bert4torch格式的reward_model的forward是否接受attention_mask参数, 自定义的forward(self, input_ids)不接受'''
+        params = inspect.signature(self.reward_model.forward).parameters.values()
+        return any(p.name == 'attention_mask' or p.kind == inspect.Parameter.VAR_KEYWORD for p in params)
+
+    def _reward_model_forward_batch(self, questions, answers):
+        # 这里reward_tokenizer是transformer格式的, 整个batch一起tokenize并padding, reward_model仅forward一次
+        is_b4t_model = isinstance(self.reward_model, BaseModel)
+        padding_side = self.reward_tokenizer.padding_side
+        if is_b4t_model:
+            self.reward_tokenizer.padding_side = 'left'
+        try:
+            inputs = self.reward_tokenizer(questions, answers, return_tensors='pt', padding=len(questions) > 1, 
+                                           truncation=True).to(self.reward_model.device)
+        finally:
+            self.reward_tokenizer.padding_side = padding_side
+
+        with inference_autocast(self.reward_model.device, enabled=self.reward_autocast):
+            if is_b4t_model:
+                # bert4torch格式, 不接受attention_mask时由模型根据pad_token_id自行生成
+                if self._reward_forward_accept_attention_mask():
+                    score = self.reward_model(inputs['input_ids'], attention_mask=inputs.get('attention_mask'))
+                else:
+                    score = self.reward_model(inputs['input_ids'])
+                if isinstance(score, torch.Tensor):
+                    score = score.detach()
+                elif isinstance(score, (list, tuple)):
+                    score = score[0].detach()
+                else:
+                    raise ValueError('Output `score` format illegal')
             else:
-                raise ValueError('Output `score` format illegal')
-        else:
-            # transformer格式
-            score = self.reward_model(**inputs).logits[0].cpu().detach()
-        return score
+                # transformer格式
+                score = self.reward_model(**inputs).logits.detach()
+        return score.float()
 
     def unwrap_model(self):
         '''返回nn.Module模块'''
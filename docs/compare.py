@@ -4,48 +4,60 @@
 import os
 import json
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+_MISSING = object()
 
 def replace_file(local_path, convert_path, replace=False):
     if replace:
         shutil.copy(convert_path, local_path)
 
-def main(local_dir, convert_dir, replace=False):
-    file_list = os.walk(local_dir)
-    for dir, sub_dir, files in file_list:
-        for file in files:
-            if file != 'bert4torch_config.json':
-                continue
-            local_path = os.path.join(dir, file)
-            convert_path = local_path.replace(local_dir, convert_dir)
-            if not os.path.exists(convert_path):
-                print(convert_path, 'not exist')
-                continue
-            
-            # 加载两边的config
-            with open(local_path, 'r', encoding='utf-8') as f:
-                local_config = json.load(f)
-            with open(convert_path, 'r', encoding='utf-8') as f:
-                convert_config = json.load(f)
-
-            break_tag = False
-            for local_k, local_v in local_config.items():
-                if (local_k not in convert_config) or (local_v != convert_config[local_k]):
-                    print(local_path, convert_path, local_k, local_v)
-                    replace_file(local_path, convert_path, replace=replace)
-                    break_tag = True
-                    break
-                else:
-                    convert_config.pop(local_k)
-            if break_tag:
-                break
-            else:
-                if len(convert_config) != 0:
-                    print(local_path, convert_path, convert_config)
-                    replace_file(local_path, convert_path, replace=replace)
+def load_config(path):
+    with open(path, 'rb') as f:
+        return json_loads(f.read())
+
+def load_pair(paths):
+    local_path, convert_path = paths
+    return load_config(local_path), load_config(convert_path)
+
+def diff_config(local_config, convert_config):
+    '''返回两边不一致的key, 及其在local和convert中的值'''
+    diff = {}
+    for k in local_config.keys() | convert_config.keys():
+        local_v, convert_v = local_config.get(k, _MISSING), convert_config.get(k, _MISSING)
+        if local_v != convert_v:
+            diff[k] = tuple(None if v is _MISSING else v for v in (local_v, convert_v))
+    return diff
+
+def main(local_dir, convert_dir, replace=False, max_workers=8):
+    # 先收集所有需要比较的文件对
+    pairs = []
+    for dir, sub_dir, files in os.walk(local_dir):
+        if 'bert4torch_config.json' not in files:
+            continue
+        local_path = os.path.join(dir, 'bert4torch_config.json')
+        convert_path = local_path.replace(local_dir, convert_dir)
+        if not os.path.exists(convert_path):
+            print(convert_path, 'not exist')
+            continue
+        pairs.append((local_path, convert_path))
+
+    # 多线程加载两边的config, 并报告所有的差异
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for (local_path, convert_path), (local_config, convert_config) in zip(pairs, executor.map(load_pair, pairs)):
+            diff = diff_config(local_config, convert_config)
+            if diff:
+                print(local_path, convert_path, diff)
+                replace_file(local_path, convert_path, replace=replace)
     print('done...')
 
 if __name__ == '__main__':
     local_dir = 'E:\pretrain_ckpt'
     convert_dir = 'E:\Github\\bert4torch\\examples\\basic'
     main(local_dir, convert_dir, replace=False)
-    main(convert_dir, local_dir, replace=False)
\ No newline at end of file
+    main(convert_dir, local_dir, replace=False)
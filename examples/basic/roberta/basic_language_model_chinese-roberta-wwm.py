@@ -9,7 +9,7 @@ from bert4torch.tokenizers import Tokenizer
 base_path = 'E:/pretrain_ckpt/roberta/hfl@chinese-roberta-wwm-ext-base/'
 dict_path = base_path + '/vocab.txt'
 config_path = base_path + '/config.json'
-checkpoint_path = base_path + '/pytorch_model.bin'
+checkpoint_path = base_path + '/pytorch_model.bin'  # 原始权重直接加载即可, 缺失的cls.predictions.decoder.bias会在加载时映射到cls.predictions.bias, 无需转换后重新保存
 
 # 分词器
 tokenizer = Tokenizer(dict_path, do_lower_case=True)
@@ -6,7 +6,8 @@ rlhf
 from glob import glob
 import torch
 from torch import nn
-from bert4torch.snippets import DottableDict, ListDataset, sequence_padding
+from torch.nn.utils.rnn import pad_sequence
+from bert4torch.snippets import DottableDict, ListDataset
 from bert4torch.models import BaseModel, build_transformer_model
 from bert4torch.generation import SeqGeneration
 from bert4torch.callbacks import Callback, Logger
@@ -69,17 +70,17 @@ PROMPT_TEMPLATE = (
 )
 
 def preprocess_function(examples):
-    new_examples = []
+    sources = []
     for conversation in examples:
         for message in conversation:
             instruction = message['value']
             input = message['from']
             if input:
                 instruction = instruction + "\n" + input
-            source = PROMPT_TEMPLATE.format_map({"instruction": instruction})
-            tokenized_question = tokenizer(source, truncation=True, max_length=max_source_length)["input_ids"]
-            new_examples.append((source, tokenized_question))
-    return new_examples
+            sources.append(PROMPT_TEMPLATE.format_map({"instruction": instruction}))
+    # 所有样本一次性tokenize, 而不是逐条调用tokenizer
+    tokenized_questions = tokenizer(sources, truncation=True, max_length=max_source_length)["input_ids"]
+    return list(zip(sources, tokenized_questions))
 
 # 加载数据集
 class MyDataset(ListDataset):
@@ -97,10 +98,10 @@ class MyDataset(ListDataset):
 def collate_fn(batch):
     batch_token_ids, batch_queries = [], []
     for query, token_ids in batch:
-        batch_token_ids.append(token_ids)
+        batch_token_ids.append(torch.tensor(token_ids, dtype=torch.long).flip(0))  # 翻转后padding，再翻转回来，实现左侧padding
         batch_queries.append(query)
 
-    batch_token_ids = torch.tensor(sequence_padding(batch_token_ids, value=pad_token_id, mode='pre'), dtype=torch.long, device=args.device)
+    batch_token_ids = pad_sequence(batch_token_ids, batch_first=True, padding_value=pad_token_id).flip(1).to(args.device)
     return {'input_ids': batch_token_ids, 'query': batch_queries}, None
 
 train_dataset = MyDataset(glob(args.data_path, recursive=True))
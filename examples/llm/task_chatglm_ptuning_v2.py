@@ -12,23 +12,24 @@
 # | chatglm+b4t+pt2+A100(pcie 40G)-fp32-bs4 |  32G      |     2600     |     25.12     |    31.55    |     7.21    |    8.02   |         |
 # | chatglm2+b4t+pt2+v100+int4+bs1          |   7G      |      ——      |     24.36     |    29.97    |     6.66    |    7.89   |         |
 
-from bert4torch.snippets import sequence_padding
 from bert4torch.callbacks import Callback
 import torch.nn as nn
 import torch
 import torch.optim as optim
 from torch.utils.data import DataLoader
+from torch.nn.utils.rnn import pad_sequence
 import torch
 from bert4torch.models import build_transformer_model, BaseModel
 from transformers import AutoTokenizer
-from bert4torch.snippets import ListDataset, seed_everything
+from bert4torch.snippets import ListDataset, seed_everything, parallel_apply
 from bert4torch.callbacks import Logger
-from bert4torch.generation import SeqGeneration
+from bert4torch.generation import SeqGeneration, token_ids_to_list
 from bert4torch.optimizers import get_linear_schedule_with_warmup
 from bert4torch.trainer import PtuningV2Trainer
 from bert4torch.losses import CausalLMLoss
 import json
 import jieba 
+jieba.initialize()  # 预先加载词典, 避免在评估时才加载
 from rouge_chinese import Rouge
 from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
 import numpy as np
@@ -89,13 +90,11 @@ if model_name in {'chatglm-6B', 'chatglm-6B-int8', 'chatglm-6B-int4'}:
         return prompt
 
     def collate_train_fn(batch):
-        batch_token_ids, batch_labels = [], []
-        for query, answer, history in batch:
-            prompt = build_prompt(query, history)
-            prompt = prefix + prompt
-            a_ids = tokenizer.encode(text=prompt, add_special_tokens=False)
-            b_ids = tokenizer.encode(text=answer, add_special_tokens=False)
-
+        # 整个batch的prompt和answer各tokenize一次
+        batch_a_ids = tokenizer([prefix + build_prompt(query, history) for query, _, history in batch], add_special_tokens=False)['input_ids']
+        batch_b_ids = tokenizer([answer for _, answer, _ in batch], add_special_tokens=False)['input_ids']
+        batch_token_ids, context_lengths = [], []
+        for a_ids, b_ids in zip(batch_a_ids, batch_b_ids):
             if len(a_ids) > max_source_length - 1:
                 a_ids = a_ids[:max_source_length - 1]
 
@@ -103,14 +102,14 @@ if model_name in {'chatglm-6B', 'chatglm-6B-int8', 'chatglm-6B-int4'}:
                 b_ids = b_ids[:max_target_length - 2]
 
             input_ids = tokenizer.build_inputs_with_special_tokens(a_ids, b_ids)
-            context_length = input_ids.index(tokenizer.bos_token_id)
-            mask_position = context_length - 1
-            labels = [tokenizer.pad_token_id] * context_length + input_ids[mask_position+1:]
+            context_lengths.append(input_ids.index(tokenizer.bos_token_id))
             batch_token_ids.append(input_ids)
-            batch_labels.append(labels)
 
-        batch_token_ids = torch.tensor(sequence_padding(batch_token_ids, value=tokenizer.pad_token_id), dtype=torch.long, device=device)
-        batch_labels = torch.tensor(sequence_padding(batch_labels, value=tokenizer.pad_token_id), dtype=torch.long, device=device)
+        batch_token_ids = pad_sequence([torch.tensor(i, dtype=torch.long) for i in batch_token_ids], batch_first=True, 
+                                       padding_value=tokenizer.pad_token_id).to(device)
+        # labels的prompt部分用pad_token_id遮盖
+        prompt_mask = torch.arange(batch_token_ids.shape[1], device=device) < torch.tensor(context_lengths, device=device)[:, None]
+        batch_labels = batch_token_ids.masked_fill(prompt_mask, tokenizer.pad_token_id)
         return [batch_token_ids], batch_labels
 else:
     def build_prompt(query, history=None):
@@ -123,21 +122,18 @@ else:
         return prompt
 
     def collate_train_fn(batch):
-        batch_token_ids, batch_labels = [], []
-        for query, answer, history in batch:
-            prompt = build_prompt(query, history)
-            prompt = prefix + prompt
-            a_ids = tokenizer.encode(text=prompt, add_special_tokens=True, truncation=True, max_length=max_source_length)
-            b_ids = tokenizer.encode(text=answer, add_special_tokens=False, truncation=True, max_length=max_target_length)
-
-            context_length = len(a_ids)
-            input_ids = a_ids + b_ids + [tokenizer.eos_token_id]
-            labels = [tokenizer.pad_token_id] * context_length + b_ids + [tokenizer.eos_token_id]
-            batch_token_ids.append(input_ids)
-            batch_labels.append(labels)
-
-        batch_token_ids = torch.tensor(sequence_padding(batch_token_ids, value=tokenizer.pad_token_id), dtype=torch.long, device=device)
-        batch_labels = torch.tensor(sequence_padding(batch_labels, value=tokenizer.pad_token_id), dtype=torch.long, device=device)
+        # 整个batch的prompt和answer各tokenize一次
+        batch_a_ids = tokenizer([prefix + build_prompt(query, history) for query, _, history in batch], 
+                                add_special_tokens=True, truncation=True, max_length=max_source_length)['input_ids']
+        batch_b_ids = tokenizer([answer for _, answer, _ in batch], add_special_tokens=False, truncation=True, max_length=max_target_length)['input_ids']
+        batch_token_ids = [a_ids + b_ids + [tokenizer.eos_token_id] for a_ids, b_ids in zip(batch_a_ids, batch_b_ids)]
+        context_lengths = [len(a_ids) for a_ids in batch_a_ids]
+
+        batch_token_ids = pad_sequence([torch.tensor(i, dtype=torch.long) for i in batch_token_ids], batch_first=True, 
+                                       padding_value=tokenizer.pad_token_id).to(device)
+        # labels的prompt部分用pad_token_id遮盖
+        prompt_mask = torch.arange(batch_token_ids.shape[1], device=device) < torch.tensor(context_lengths, device=device)[:, None]
+        batch_labels = batch_token_ids.masked_fill(prompt_mask, tokenizer.pad_token_id)
         return [batch_token_ids], batch_labels
 
 def collate_dev_fn(batch):
@@ -174,10 +170,25 @@ class Chat(SeqGeneration):
     def pre_process(self, text):
         return [tokenizer(text, max_length=max_source_length, truncation=True)['input_ids']]
     def post_process(self, output_ids):
-        return [tokenizer.decode(output_id.cpu().numpy()) for output_id in output_ids]
+        return tokenizer.batch_decode(token_ids_to_list(output_ids))
 generation = Chat(model, tokenizer, start_id=None, end_id=tokenizer.eos_token_id, pad_id=tokenizer.pad_token_id, 
                   mode='random_sample', maxlen=512, default_rtype='logits', use_states=use_states)
 
+rouge = Rouge()
+smoothing_function = SmoothingFunction().method3
+def score_one(pair):
+    '''计算单条样本的rouge和bleu, 定义在模块层级以便多进程调用'''
+    pred, label = pair
+    hypothesis = jieba.lcut(pred)
+    reference = jieba.lcut(label)
+    try:
+        result = rouge.get_scores(' '.join(hypothesis) , ' '.join(reference))[0]
+    except ValueError:
+        # pred或label为空时Rouge会报错, 异常会导致parallel_apply的worker退出而卡住, 这里直接记为0分
+        result = {k: {'f': 0.0} for k in ['rouge-1', 'rouge-2', 'rouge-l']}
+    bleu_score = sentence_bleu([list(label)], list(pred), smoothing_function=smoothing_function)
+    return result, bleu_score
+
 class Evaluator(Callback):
     """评估与保存
     """
@@ -197,25 +208,21 @@ class Evaluator(Callback):
     
     def evaluate(self, data, epoch='final'):
         preds, labels = [], []
-        for prompt, label in tqdm(data, desc='Evaluating'):
-            pred = generation.generate(prompt, topk=50, topp=0.7, temperature=0.95)
-            preds.extend(pred)
-            labels.extend(label)
-            with open(f'./preds_{epoch}.txt', 'a+', encoding='utf-8') as f:
+        with open(f'./preds_{epoch}.txt', 'a+', encoding='utf-8') as f:
+            for prompt, label in tqdm(data, desc='Evaluating'):
+                # prompt是一个batch的list, generate内部按batch生成
+                pred = generation.generate(prompt, topk=50, topp=0.7, temperature=0.95)
+                preds.extend(pred)
+                labels.extend(label)
                 for pred_i, label_i in zip(pred, label):
                     f.write(json.dumps({'pred': pred_i, 'label': label_i}, ensure_ascii=False) + '\n')
 
+        # 打分是纯cpu计算, 多进程并行(windows下只能用多线程)
         score_dict = {"rouge-1": [], "rouge-2": [], "rouge-l": [], "bleu-4": []}
-        for pred, label in zip(preds, labels):
-            hypothesis = list(jieba.cut(pred))
-            reference = list(jieba.cut(label))
-            rouge = Rouge()
-            scores = rouge.get_scores(' '.join(hypothesis) , ' '.join(reference))
-            result = scores[0]
-            
+        results = parallel_apply(score_one, zip(preds, labels), workers=min(8, os.cpu_count()), max_queue_size=1000, dummy=(os.name == 'nt'))
+        for result, bleu_score in results:
             for k, v in result.items():
                 score_dict[k].append(round(v["f"] * 100, 4))
-            bleu_score = sentence_bleu([list(label)], list(pred), smoothing_function=SmoothingFunction().method3)
             score_dict["bleu-4"].append(round(bleu_score * 100, 4))
 
         for k, v in score_dict.items():